@@ -4,216 +4,175 @@ PDF Text Replacement Tool - Web UI
 Interactive UI for replacing text in PDFs with preview functionality.
 """
 
+import atexit
+import hashlib
+import logging
+import shutil
 import streamlit as st
 import fitz  # PyMuPDF
-from collections import Counter
 import io
 from pathlib import Path
 import tempfile
+import threading
+import time
+import uuid
 
+import pdf_core
 
-def sample_background_color(page, rect):
-    """Sample the background color by looking at pixels around the text."""
-    try:
-        expanded = fitz.Rect(rect.x0 - 5, rect.y0 - 2, rect.x1 + 5, rect.y1 + 2)
-        pix = page.get_pixmap(clip=expanded, alpha=False)
-
-        samples = []
-        width = pix.width
-        height = pix.height
-
-        for x in range(0, width, max(1, width // 10)):
-            if height > 0:
-                pixel_top = pix.pixel(x, 0)
-                samples.append(pixel_top[:3])
-            if height > 1:
-                pixel_bottom = pix.pixel(x, height - 1)
-                samples.append(pixel_bottom[:3])
-
-        if samples:
-            color_counter = Counter(samples)
-            most_common_rgb = color_counter.most_common(1)[0][0]
-            return (most_common_rgb[0] / 255.0,
-                   most_common_rgb[1] / 255.0,
-                   most_common_rgb[2] / 255.0)
-    except Exception as e:
-        st.warning(f"Could not sample background color: {e}")
-
-    return (1, 1, 1)
-
-
-def find_text_instances(pdf_bytes, search_text):
-    """Find all instances of search text in the PDF and return details."""
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    instances = []
-
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-        text_instances = page.search_for(search_text)
-
-        if text_instances:
-            blocks = page.get_text("dict")["blocks"]
-
-            for inst in text_instances:
-                for block in blocks:
-                    if "lines" in block:
-                        for line in block["lines"]:
-                            for span in line["spans"]:
-                                span_rect = fitz.Rect(span["bbox"])
-
-                                if span_rect.intersects(inst) and search_text in span["text"]:
-                                    font_size = span["size"]
-                                    font_color = span["color"]
-
-                                    # Convert color
-                                    if isinstance(font_color, int):
-                                        r = ((font_color >> 16) & 0xFF) / 255.0
-                                        g = ((font_color >> 8) & 0xFF) / 255.0
-                                        b = (font_color & 0xFF) / 255.0
-                                        text_color = (r, g, b)
-                                    else:
-                                        text_color = (0, 0, 0)
-
-                                    bg_color = sample_background_color(page, inst)
-
-                                    instances.append({
-                                        'page': page_num + 1,
-                                        'rect': inst,
-                                        'text': search_text,
-                                        'size': font_size,
-                                        'text_color': text_color,
-                                        'bg_color': bg_color,
-                                        'context': span["text"]
-                                    })
-                                    break
-
-    doc.close()
-    return instances
-
-
-def replace_text_in_pdf(pdf_bytes, search_text, replace_text):
-    """Replace text in PDF and return the modified PDF bytes."""
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    replacements_count = 0
-
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-
-        # Save original page dimensions to restore later
-        original_mediabox = page.mediabox
-        original_cropbox = page.cropbox
-
-        text_instances = page.search_for(search_text)
-
-        if text_instances:
-            blocks = page.get_text("dict")["blocks"]
-            replacements = []
-
-            for inst in text_instances:
-                for block in blocks:
-                    if "lines" in block:
-                        for line in block["lines"]:
-                            for span in line["spans"]:
-                                span_rect = fitz.Rect(span["bbox"])
-
-                                if span_rect.intersects(inst) and search_text in span["text"]:
-                                    font_size = span["size"]
-                                    font_color = span["color"]
-                                    font_flags = span.get("flags", 0)
-
-                                    # Convert color
-                                    if isinstance(font_color, int):
-                                        r = ((font_color >> 16) & 0xFF) / 255.0
-                                        g = ((font_color >> 8) & 0xFF) / 255.0
-                                        b = (font_color & 0xFF) / 255.0
-                                        text_color = (r, g, b)
-                                    else:
-                                        text_color = (0, 0, 0)
-
-                                    # Detect font style
-                                    fontname = "helv"
-                                    if font_flags & 2**4:  # Bold
-                                        fontname = "hebo"
-
-                                    replacements.append({
-                                        'rect': inst,
-                                        'size': font_size,
-                                        'color': text_color,
-                                        'fontname': fontname,
-                                    })
-
-                                    replacements_count += 1
-                                    break
-
-            # Clean content stream first - remove text in those areas
-            for repl in replacements:
-                rect = repl['rect']
-                bg_color = sample_background_color(page, rect)
-                # Add redaction annotation with background color (no border)
-                # Extend slightly to ensure complete coverage
-                extended_rect = fitz.Rect(rect.x0 - 1, rect.y0 - 1, rect.x1 + 1, rect.y1 + 1)
-                page.add_redact_annot(extended_rect, fill=bg_color)
-
-            # Apply redactions to remove original text
-            if replacements:
-                page.apply_redactions(images=fitz.PDF_REDACT_IMAGE_NONE)
-
-            # Now add replacement text (background already filled by redaction)
-            for repl in replacements:
-                rect = repl['rect']
-
-                # Calculate font size to fit the new text in the same width
-                old_width = rect.width
-                fontsize = repl['size']
-                fontname = repl['fontname']
-
-                # Calculate text width with current font size
-                text_width = fitz.get_text_length(replace_text, fontname=fontname, fontsize=fontsize)
-
-                # Scale font size if text is too wide
-                if text_width > old_width:
-                    fontsize = fontsize * (old_width / text_width) * 0.95  # 95% to add small margin
-
-                # Insert new text at the same position
-                # Use the same baseline calculation as the original text
-                page.insert_text(
-                    (rect.x0, rect.y1 - (rect.height * 0.15)),  # Better baseline alignment
-                    replace_text,
-                    fontsize=fontsize,
-                    color=repl['color'],
-                    fontname=fontname
-                )
+# Modified PDFs older than this (in seconds) are left over from abandoned sessions
+MODIFIED_PDF_TTL = 60 * 60
 
-            # Restore original page dimensions (redaction can modify them)
-            page.set_mediabox(original_mediabox)
-            page.set_cropbox(original_cropbox)
 
-    # Save to bytes with minimal modifications to preserve layout
-    output_bytes = doc.write(
-        garbage=4,
-        deflate=True,
-        clean=False,  # Don't clean to preserve exact structure
-        pretty=True
-    )
-    doc.close()
+class StreamlitWarningHandler(logging.Handler):
+    """Show log records as warnings on the page whose script emitted them."""
+
+    def emit(self, record):
+        st.warning(self.format(record))
+
+
+@st.cache_resource(show_spinner=False)
+def show_core_warnings():
+    """Surface pdf_core's warnings (e.g. failed background sampling) in the app, once per server."""
+    pdf_core.logger.addHandler(StreamlitWarningHandler())
+
+
+def pdf_digest(pdf_bytes):
+    """Return a content hash identifying the PDF in cache keys."""
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def open_pdf(pdf_key, _pdf_bytes):
+    """Open a PDF once and share the parsed document across reruns and sessions.
+
+    Cached on ``pdf_key`` (see ``pdf_digest``) so the bytes aren't rehashed on every call.
+    Returns ``(doc, lock)``: PyMuPDF is not thread-safe, so callers must hold the lock
+    while using the document, and must not modify or close it.
+    """
+    return fitz.open(stream=_pdf_bytes, filetype="pdf"), threading.Lock()
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def find_text_instances(pdf_key, _pdf_bytes, search_text):
+    """Find all instances of search text in the PDF, cached on the PDF's content hash.
+
+    Returns ``(instances, bg_cache)``; the background samples are part of the cached
+    result so a cache hit still hands them to the replacement preview.
+    """
+    bg_cache = {}
+    doc, lock = open_pdf(pdf_key, _pdf_bytes)
+    with lock:
+        instances = pdf_core.find_text_instances(doc, search_text, bg_cache)
+    return instances, bg_cache
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def render_pdf_preview(pdf_key, _pdf_bytes, page_num=0, zoom=1.5):
+    """Render a PDF page as an image for preview, cached on the PDF's content hash."""
+    doc, lock = open_pdf(pdf_key, _pdf_bytes)
+    with lock:
+        return pdf_core.render_pdf_preview(doc, page_num, zoom)
+
+
+@st.cache_resource(show_spinner=False)
+def temp_pdf_dir():
+    """Create the directory holding the sessions' modified PDFs once, removed on exit."""
+    path = Path(tempfile.mkdtemp(prefix="pdf-text-replacer-"))
+    atexit.register(shutil.rmtree, path, ignore_errors=True)
+    return path
+
+
+def save_temp_pdf(doc):
+    """Save a document to the session's temporary file and return its path.
+
+    Each session overwrites a single file; files of abandoned sessions are deleted
+    once they are older than MODIFIED_PDF_TTL.
+    """
+    temp_dir = temp_pdf_dir()
+
+    cutoff = time.time() - MODIFIED_PDF_TTL
+    for old_file in temp_dir.glob("*.pdf"):
+        try:
+            if old_file.stat().st_mtime < cutoff:
+                old_file.unlink()
+        except FileNotFoundError:
+            pass  # Removed concurrently by another session
 
-    return output_bytes, replacements_count
+    session_id = st.session_state.setdefault('temp_pdf_id', uuid.uuid4().hex)
+    path = str(temp_dir / f"{session_id}.pdf")
 
+    # Save with minimal modifications to preserve layout
+    doc.save(path, garbage=4, deflate=True, clean=False)
+    return path
 
-def render_pdf_preview(pdf_bytes, page_num=0, zoom=2.0):
-    """Render a PDF page as an image for preview."""
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    page = doc[page_num]
 
-    # Render page to image
-    mat = fitz.Matrix(zoom, zoom)
-    pix = page.get_pixmap(matrix=mat)
+def discard_modified_pdf():
+    """Delete the session's modified PDF and preview, if any, so they are regenerated."""
+    st.session_state.pop('modified_preview', None)
+    path = st.session_state.pop('modified_path', None)
+    if path:
+        Path(path).unlink(missing_ok=True)
 
-    # Convert to PNG bytes
-    img_bytes = pix.tobytes("png")
-    doc.close()
 
-    return img_bytes
+@st.fragment
+def preview_section(output_filename):
+    """Render the before/after preview and download button for the current search.
+
+    Runs as a fragment so interacting with it doesn't rerun the whole app.
+    """
+    instances = st.session_state['instances']
+
+    # Preview section, showing the first page with a replacement
+    st.subheader("👁️ Preview")
+    preview_page = min(inst['page'] for inst in instances) - 1
+
+    col1, col2 = st.columns(2)
+
+    with col1:
+        st.markdown(f"**Original PDF** (page {preview_page + 1})")
+        original_preview = render_pdf_preview(
+            st.session_state['pdf_key'],
+            st.session_state['pdf_bytes'],
+            preview_page
+        )
+        st.image(original_preview, use_container_width=True)
+
+    with col2:
+        st.markdown(f"**After Replacement** (page {preview_page + 1})")
+        # The file may have expired while the session sat idle
+        if 'modified_path' in st.session_state and not Path(st.session_state['modified_path']).exists():
+            discard_modified_pdf()
+        if 'modified_path' not in st.session_state:
+            with st.spinner("Generating preview..."):
+                # Render straight from the modified in-memory document and save it
+                # once to disk, keeping only the preview and file path in the session
+                doc = fitz.open(stream=st.session_state['pdf_bytes'], filetype="pdf")
+                pdf_core.apply_replacements(
+                    doc,
+                    st.session_state['search_text'],
+                    st.session_state['replace_text'],
+                    st.session_state['bg_cache']
+                )
+                st.session_state['modified_preview'] = pdf_core.render_pdf_preview(doc, preview_page)
+                st.session_state['modified_path'] = save_temp_pdf(doc)
+                doc.close()
+
+        st.image(st.session_state['modified_preview'], use_container_width=True)
+
+    # Download button
+    if 'modified_path' in st.session_state:
+        st.divider()
+
+        # Read the file only when the user clicks download, rather than on every rerun
+        st.download_button(
+            label="⬇️ Download Modified PDF",
+            data=lambda path=st.session_state['modified_path']: Path(path).read_bytes(),
+            file_name=output_filename,
+            mime="application/pdf",
+            type="primary"
+        )
+
+        st.success(f"✓ Ready to download: {output_filename}")
 
 
 def main():
@@ -223,6 +182,8 @@ def main():
         layout="wide"
     )
 
+    show_core_warnings()
+
     st.title("📄 PDF Text Replacement Tool")
     st.markdown("Upload a PDF, specify text to find and replace, preview changes, and download the result.")
 
@@ -232,22 +193,30 @@ def main():
     if uploaded_file is not None:
         pdf_bytes = uploaded_file.read()
 
-        # Create two columns for input
-        col1, col2 = st.columns(2)
+        # Inputs live in a form so editing them doesn't rerun the app until submitted
+        with st.form("replace_form"):
+            col1, col2 = st.columns(2)
+
+            with col1:
+                search_text = st.text_input("Text to find:", value="Premium", key="search")
 
-        with col1:
-            search_text = st.text_input("Text to find:", value="Premium", key="search")
+            with col2:
+                replace_text = st.text_input("Replace with:", value="Standard", key="replace")
 
-        with col2:
-            replace_text = st.text_input("Replace with:", value="Standard", key="replace")
+            # Search button
+            submitted = st.form_submit_button("🔍 Find Instances", type="primary")
 
-        # Search button
-        if st.button("🔍 Find Instances", type="primary"):
+        if submitted:
             if search_text:
                 with st.spinner("Searching for text instances..."):
-                    instances = find_text_instances(pdf_bytes, search_text)
+                    # Background samples are reused by the replacement preview
+                    pdf_key = pdf_digest(pdf_bytes)
+                    instances, bg_cache = find_text_instances(pdf_key, pdf_bytes, search_text)
+                    st.session_state['bg_cache'] = bg_cache
+                    discard_modified_pdf()
                     st.session_state['instances'] = instances
                     st.session_state['pdf_bytes'] = pdf_bytes
+                    st.session_state['pdf_key'] = pdf_key
                     st.session_state['search_text'] = search_text
                     st.session_state['replace_text'] = replace_text
 
@@ -270,45 +239,9 @@ def main():
                     """)
                     st.divider()
 
-            # Preview section
-            st.subheader("👁️ Preview")
-
-            col1, col2 = st.columns(2)
-
-            with col1:
-                st.markdown("**Original PDF**")
-                original_preview = render_pdf_preview(st.session_state['pdf_bytes'])
-                st.image(original_preview, use_container_width=True)
-
-            with col2:
-                st.markdown("**After Replacement**")
-                with st.spinner("Generating preview..."):
-                    modified_bytes, _ = replace_text_in_pdf(
-                        st.session_state['pdf_bytes'],
-                        st.session_state['search_text'],
-                        st.session_state['replace_text']
-                    )
-                    modified_preview = render_pdf_preview(modified_bytes)
-                    st.image(modified_preview, use_container_width=True)
-                    st.session_state['modified_bytes'] = modified_bytes
-
-            # Download button
-            if 'modified_bytes' in st.session_state:
-                st.divider()
-
-                # Generate filename
-                original_name = Path(uploaded_file.name).stem
-                output_filename = f"{original_name}_modified.pdf"
-
-                st.download_button(
-                    label="⬇️ Download Modified PDF",
-                    data=st.session_state['modified_bytes'],
-                    file_name=output_filename,
-                    mime="application/pdf",
-                    type="primary"
-                )
-
-                st.success(f"✓ Ready to download: {output_filename}")
+            # Generate filename
+            original_name = Path(uploaded_file.name).stem
+            preview_section(f"{original_name}_modified.pdf")
 
         elif 'instances' in st.session_state and not st.session_state['instances']:
             st.warning(f"No instances of '{st.session_state['search_text']}' found in the PDF.")
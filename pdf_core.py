@@ -0,0 +1,337 @@
+"""
+PDF Text Replacement Tool - Core
+PDF processing shared by the web UI (app.py) and the command-line tool (pdf_replace.py).
+"""
+
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import fitz  # PyMuPDF
+import numpy as np
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+
+logger = logging.getLogger(__name__)
+
+# Horizontal zoom used when rasterizing the area around text to sample its background
+BG_SAMPLE_SCALE = 0.25
+
+# Text extraction flags for the TextPage shared by span lookup and search
+TEXTPAGE_FLAGS = fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_MEDIABOX_CLIP
+
+# Documents with at least this many pages are analyzed in a process pool on
+# multi-core hosts. Spawning workers costs ~0.27s while planning a text-only
+# page takes ~3ms (~10ms with background sampling), so with 4 workers the pool
+# only pays off beyond ~120 pages; retune from a multi-core benchmark if needed
+PARALLEL_MIN_PAGES = 128
+
+
+def sample_background_color(page, rect, cache=None):
+    """
+    Sample the background color by looking at pixels around the text.
+    Returns RGB tuple, memoized in cache (if given) per page and rect rounded to 1px.
+    """
+    key = (page.number, round(rect.x0), round(rect.y0), round(rect.x1), round(rect.y1))
+    if cache is not None and key in cache:
+        return cache[key]
+
+    bg_color = (1, 1, 1)  # Default to white
+    try:
+        # Expand rect slightly to get surrounding pixels
+        expanded = fitz.Rect(rect.x0 - 5, rect.y0 - 2, rect.x1 + 5, rect.y1 + 2)
+
+        # Get pixmap of the area; only the modal edge color matters, so render
+        # at reduced horizontal resolution unless the area would become too narrow.
+        # Vertical resolution stays full: the clip extends only 2pt beyond the
+        # text, so coarser edge rows would blend the background with what lies outside
+        scale = BG_SAMPLE_SCALE
+        if expanded.width * scale < 4:
+            scale = 1.0
+        pix = page.get_pixmap(matrix=fitz.Matrix(scale, 1), clip=expanded, alpha=False)
+
+        # View the raw samples as a height x width x channels array
+        pixels = np.frombuffer(pix.samples, dtype=np.uint8).reshape(
+            pix.height, pix.stride)[:, :pix.width * pix.n].reshape(pix.height, pix.width, pix.n)
+
+        # Sample pixels from the top and bottom edges (likely to be background)
+        step = max(1, pix.width // 10)
+        edge_rows = sorted({0, pix.height - 1}) if pix.height else []
+        samples = pixels[edge_rows, ::step, :3].reshape(-1, 3)  # RGB only
+
+        # Find most common color (likely background)
+        if len(samples):
+            # Pack each RGB triple into one uint32 so counting works on scalars
+            rgb = samples.astype(np.uint32)
+            packed = (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+            colors, counts = np.unique(packed, return_counts=True)
+            most_common = int(colors[counts.argmax()])
+            # Convert to 0-1 range
+            bg_color = (((most_common >> 16) & 0xFF) / 255.0,
+                        ((most_common >> 8) & 0xFF) / 255.0,
+                        (most_common & 0xFF) / 255.0)
+    except Exception as e:
+        logger.warning("Could not sample background color: %s", e)
+
+    if cache is not None:
+        cache[key] = bg_color
+    return bg_color
+
+
+def has_plain_background(page):
+    """Return True if the page draws nothing but text, so its background is plain white."""
+    if page.get_images(full=False):
+        return False
+    return all(kind.endswith("-text") for kind, _ in page.get_bboxlog())
+
+
+def convert_color(font_color, cache):
+    """Convert a span's integer sRGB color to an RGB tuple, memoized in cache."""
+    if not isinstance(font_color, int):
+        return (0, 0, 0)
+
+    text_color = cache.get(font_color)
+    if text_color is None:
+        r = ((font_color >> 16) & 0xFF) / 255.0
+        g = ((font_color >> 8) & 0xFF) / 255.0
+        b = (font_color & 0xFF) / 255.0
+        text_color = cache[font_color] = (r, g, b)
+    return text_color
+
+
+def iter_spans(blocks):
+    """Yield every text span in the page blocks."""
+    for block in blocks:
+        for line in block.get("lines", ()):
+            yield from line["spans"]
+
+
+def build_span_index(blocks, search_text):
+    """Flatten the text spans containing the search text into a list sorted by top edge."""
+    spans = sorted(
+        ((fitz.Rect(span["bbox"]), span) for span in iter_spans(blocks) if search_text in span["text"]),
+        key=lambda item: item[0].y0
+    )
+    tops = [span_rect.y0 for span_rect, _ in spans]
+    max_height = max((span_rect.height for span_rect, _ in spans), default=0)
+    return tops, spans, max_height
+
+
+def find_span_for(span_index, inst):
+    """Return the first indexed span overlapping the instance."""
+    tops, spans, max_height = span_index
+
+    # Only spans starting less than one span height above the instance can overlap it
+    start = bisect_left(tops, inst.y0 - max_height)
+    end = bisect_left(tops, inst.y1)
+
+    candidates = (spans[i] for i in range(start, end))
+    return next((span for span_rect, span in candidates if span_rect.intersects(inst)), None)
+
+
+def plan_page_replacements(page, search_text, bg_cache=None):
+    """
+    Collect the replacements for one page without modifying it.
+    Rects are returned as plain tuples so plans can cross process boundaries.
+    """
+    replacements = []
+    color_cache = {}
+
+    # Extract the page text once and share it between span lookup and search
+    textpage = page.get_textpage(flags=TEXTPAGE_FLAGS)
+
+    # A span containing the search text also shows up in the plain text, so
+    # use that cheap substring check before building the full span dict
+    if search_text not in page.get_text("text", textpage=textpage):
+        return replacements
+
+    # Pages without a span containing the exact search text cannot match,
+    # so skip them before running the layout-aware search
+    span_index = build_span_index(page.get_text("dict", textpage=textpage)["blocks"], search_text)
+    if not span_index[1]:
+        return replacements
+
+    text_instances = page.search_for(search_text, textpage=textpage)
+
+    if text_instances:
+        # Text-only pages need no pixel sampling
+        plain_background = has_plain_background(page)
+
+        for inst in text_instances:
+            span = find_span_for(span_index, inst)
+            if span is None:
+                continue
+
+            font_size = span["size"]
+            font_color = span["color"]
+            font_flags = span.get("flags", 0)
+
+            text_color = convert_color(font_color, color_cache)
+
+            # Detect font style
+            fontname = "helv"
+            if font_flags & 2**4:  # Bold
+                fontname = "hebo"
+
+            # Sample actual background color from the PDF
+            if plain_background:
+                bg_color = (1, 1, 1)
+            else:
+                bg_color = sample_background_color(page, inst, bg_cache)
+
+            replacements.append({
+                'rect': tuple(inst),
+                'size': font_size,
+                'color': text_color,
+                'fontname': fontname,
+                'bg_color': bg_color,
+                'context': span["text"],
+            })
+
+    return replacements
+
+
+# Per-process state for the page planning pool
+_worker_doc = None
+_worker_bg_cache = None
+
+
+def _init_plan_worker(path, log_queue):
+    """Open the input document once per worker process, with its own background cache."""
+    global _worker_doc, _worker_bg_cache
+    _worker_doc = fitz.open(path)
+    _worker_bg_cache = {}
+
+    # Spawned workers don't inherit the caller's logging setup, so hand
+    # warnings back to the parent process to be reported there
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.propagate = False
+
+
+def _plan_page_worker(page_num, search_text):
+    """Plan the replacements of a single page in a worker process."""
+    return plan_page_replacements(_worker_doc[page_num], search_text, _worker_bg_cache)
+
+
+def plan_replacements(doc, search_text, bg_cache=None, path=None):
+    """
+    Plan the replacements of every page. When the document's file path is given,
+    documents with at least PARALLEL_MIN_PAGES pages are analyzed in a process
+    pool if more than one CPU is available. Background samples taken by the
+    pool's workers stay in those workers and are not added to bg_cache.
+    """
+    if bg_cache is None:
+        bg_cache = {}
+
+    page_count = len(doc)
+    cpu_count = os.cpu_count() or 1
+    if path is None or cpu_count < 2 or page_count < PARALLEL_MIN_PAGES:
+        return [plan_page_replacements(page, search_text, bg_cache) for page in doc]
+
+    # Spawn rather than fork: the caller may be multi-threaded (e.g. the Streamlit server)
+    context = multiprocessing.get_context("spawn")
+    chunksize = max(1, page_count // (4 * cpu_count))
+    log_queue = context.Queue()
+    log_listener = logging.handlers.QueueListener(log_queue, logger)
+    log_listener.start()
+    try:
+        with ProcessPoolExecutor(mp_context=context, initializer=_init_plan_worker,
+                                 initargs=(path, log_queue)) as pool:
+            return list(pool.map(_plan_page_worker, range(page_count), repeat(search_text, page_count),
+                                 chunksize=chunksize))
+    finally:
+        log_listener.stop()
+
+
+def find_text_instances(doc, search_text, bg_cache=None):
+    """Find all instances of search text in the PDF and return details."""
+    instances = []
+
+    for page_num, page in enumerate(doc):
+        for repl in plan_page_replacements(page, search_text, bg_cache):
+            instances.append({
+                'page': page_num + 1,
+                'rect': repl['rect'],
+                'text': search_text,
+                'size': repl['size'],
+                'text_color': repl['color'],
+                'bg_color': repl['bg_color'],
+                'context': repl['context']
+            })
+
+    return instances
+
+
+def apply_page_replacements(page, replacements, replace_text):
+    """Replace the planned occurrences on one page with the new text."""
+    # Save original page dimensions to restore later
+    original_mediabox = page.mediabox
+    original_cropbox = page.cropbox
+
+    # Clean content stream first - remove text in those areas
+    for repl in replacements:
+        rect = fitz.Rect(repl['rect'])
+        # Add redaction annotation with background color (no border)
+        # Extend slightly to ensure complete coverage
+        extended_rect = fitz.Rect(rect.x0 - 1, rect.y0 - 1, rect.x1 + 1, rect.y1 + 1)
+        page.add_redact_annot(extended_rect, fill=repl['bg_color'])
+
+    # Apply redactions to remove original text
+    page.apply_redactions(images=fitz.PDF_REDACT_IMAGE_NONE)
+
+    # Now add replacement text (background already filled by redaction),
+    # batched into a single content stream addition
+    shape = page.new_shape()
+    for repl in replacements:
+        rect = fitz.Rect(repl['rect'])
+
+        # Calculate font size to fit the new text in the same width
+        old_width = rect.width
+        fontsize = repl['size']
+        fontname = repl['fontname']
+
+        # Calculate text width with current font size
+        text_width = fitz.get_text_length(replace_text, fontname=fontname, fontsize=fontsize)
+
+        # Scale font size if text is too wide
+        if text_width > old_width:
+            fontsize = fontsize * (old_width / text_width) * 0.95  # 95% to add small margin
+
+        # Insert new text at the same position
+        # Use the same baseline calculation as the original text
+        shape.insert_text(
+            (rect.x0, rect.y1 - (rect.height * 0.15)),  # Better baseline alignment
+            replace_text,
+            fontsize=fontsize,
+            color=repl['color'],
+            fontname=fontname
+        )
+    shape.commit()
+
+    # Restore original page dimensions (redaction can modify them)
+    page.set_mediabox(original_mediabox)
+    page.set_cropbox(original_cropbox)
+
+
+def apply_replacements(doc, search_text, replace_text, bg_cache=None, path=None):
+    """
+    Replace text in an open document in place and return the replacements
+    made on each page. Pages are analyzed first (in parallel for large
+    documents when their path is given), then modified here in a single process.
+    """
+    page_plans = plan_replacements(doc, search_text, bg_cache, path)
+
+    for page_num, replacements in enumerate(page_plans):
+        if replacements:
+            apply_page_replacements(doc[page_num], replacements, replace_text)
+
+    return page_plans
+
+
+def render_pdf_preview(doc, page_num=0, zoom=1.5):
+    """Render a PDF page as PNG bytes for preview."""
+    mat = fitz.Matrix(zoom, zoom)
+    pix = doc[page_num].get_pixmap(matrix=mat)
+    return pix.tobytes("png")